@@ -1,5 +1,10 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from numba import njit
 from pathlib import Path
 import os
 
@@ -7,9 +12,118 @@ import os
 PROCESSED_PATH_EA = Path('Combined/eda')
 PROCESSED_PATH_PG = Path('Combined/ppg')
 COMBINED_PATH = Path('Combined/eda_ppg')
+OUTPUT_FORMAT = 'parquet'  # ใช้ 'csv' ถ้าต้องการไฟล์ผลลัพธ์แบบเดิม
+
+# Multi-threaded Arrow CSV reader settings
+CSV_READ_OPTIONS = pacsv.ReadOptions(use_threads=True, block_size=8 << 20)
+# Keep DateTime as text: Arrow would shift "+07:00" timestamps to UTC, pandas keeps local time
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(column_types={'DateTime': pa.string()})
+# ระยะห่างสูงสุดที่ยอมให้จับคู่ EDA กับ PPG (1 วินาที หน่วยนาโนวินาที)
+MERGE_TOLERANCE_NS = np.int64(1_000_000_000)
+# คอลัมน์ข้อความที่มีค่าซ้ำกันมาก เก็บเป็น category แทน string ทีละแถว
+CATEGORY_COLUMNS = [f"{col_prefix}{col_suffix}"
+                    for col_prefix in ['gender', 'type', 'bmi_category', 'id']
+                    for col_suffix in ['', '_eda', '_ppg']]
+
+
+def read_csv_table(file_path: Path) -> pa.Table:
+    """Read a CSV file into an Arrow table, falling back to pandas for mixed-type columns"""
+    try:
+        return pacsv.read_csv(file_path, read_options=CSV_READ_OPTIONS, convert_options=CSV_CONVERT_OPTIONS)
+    except pa.ArrowInvalid:
+        # Arrow infers types from the first block only; mixed columns need the slower pandas parser
+        df = pd.read_csv(file_path, low_memory=False)
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+def get_sidecar_path(file_path: Path) -> Path:
+    """Get the hidden Parquet cache file stored next to a CSV file"""
+    return file_path.with_name(f".{file_path.name}.parquet")
+
+def convert_column_types(df: pd.DataFrame, file_name: str) -> pd.DataFrame:
+    """Convert DateTime and numeric label columns of a loaded file"""
+    # Convert DateTime column to datetime if it exists - with better error handling
+    if 'DateTime' in df.columns:
+        try:
+            # Try multiple datetime parsing approaches
+            try:
+                # First try the default parsing
+                df['DateTime'] = pd.to_datetime(df['DateTime'])
+            except:
+                # If that fails, try with format='mixed' which is more flexible
+                df['DateTime'] = pd.to_datetime(df['DateTime'], format='mixed')
+        except Exception as dt_error:
+            print(f"  - Warning: DateTime conversion error in {file_name}: {str(dt_error)}")
+            print(f"  - Attempting alternative datetime parsing...")
+            
+            # Try to handle timezone formats that might be causing issues
+            # ตัด timezone ออกทั้งคอลัมน์ในครั้งเดียวแทนการ apply ทีละแถว
+            datetime_text = df['DateTime'].astype(str).str.split('+', n=1).str[0]
+            df['DateTime'] = pd.to_datetime(datetime_text, format='ISO8601', cache=True, errors='coerce')
+    
+    # สำหรับคอลัมน์ bmi และ sleep ที่ลงท้ายด้วย _eda หรือ _ppg พยายามแปลงเป็นตัวเลขถ้าเป็นไปได้
+    numeric_cols = [f"{col_prefix}{col_suffix}"
+                    for col_suffix in ['_eda', '_ppg']
+                    for col_prefix in ['bmi', 'sleep']
+                    if f"{col_prefix}{col_suffix}" in df.columns]
+    if numeric_cols:
+        # แปลงทุกคอลัมน์ในครั้งเดียว
+        df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors='coerce')
+    
+    return df
+
+def encode_category_columns(table: pa.Table) -> pa.Table:
+    """Dictionary-encode low-cardinality label columns so pandas gets category dtype"""
+    for i, field in enumerate(table.schema):
+        if field.name not in CATEGORY_COLUMNS:
+            continue
+        column = table.column(i)
+        # ทำให้ทุกไฟล์ได้ชนิดเดียวกัน dictionary<int32, string> ไม่ว่าจะมาจาก cache, CSV หรือ parquet
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        if pa.types.is_null(column.type) or pa.types.is_large_string(column.type):
+            column = column.cast(pa.string())
+        if pa.types.is_string(column.type):
+            table = table.set_column(i, field.name, pc.dictionary_encode(column))
+    return table
+
+def load_data_file(file_path: Path) -> pa.Table:
+    """Load one CSV or Parquet file with converted column types, using the Parquet cache for CSV files when it is up to date"""
+    if file_path.suffix == '.parquet':
+        # ไฟล์ parquet มี dtype อยู่แล้ว ไม่ต้องเขียน cache ซ้ำอีกชุด
+        df = convert_column_types(pq.read_table(file_path).to_pandas(self_destruct=True), file_path.name)
+        return encode_category_columns(pa.Table.from_pandas(df, preserve_index=False))
+    
+    sidecar = get_sidecar_path(file_path)
+    if sidecar.exists() and sidecar.stat().st_mtime >= file_path.stat().st_mtime:
+        # ไฟล์ cache ใหม่กว่าไฟล์ต้นฉบับแล้ว อ่าน parquet ได้เลยไม่ต้องแปลง DateTime ซ้ำ
+        return encode_category_columns(pq.read_table(sidecar))
+    
+    df = convert_column_types(read_csv_table(file_path).to_pandas(self_destruct=True), file_path.name)
+    
+    # บันทึก cache ไว้ใช้รอบถัดไป ถ้าเขียนไม่ได้ก็ข้ามไป
+    try:
+        df.to_parquet(sidecar, engine='pyarrow', compression='zstd', index=False)
+    except Exception as cache_error:
+        print(f"  - Warning: Could not write cache {sidecar.name}: {str(cache_error)}")
+    
+    return encode_category_columns(pa.Table.from_pandas(df, preserve_index=False))
+
+def list_data_files(directory_path: Path) -> list:
+    """List CSV and Parquet files in a directory (sorted by name), keeping the newer file when both formats exist"""
+    latest_files = {}
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            # ข้ามไฟล์ cache ที่ซ่อนอยู่
+            if entry.name.startswith('.') or not entry.name.endswith(('.csv', '.parquet')) or not entry.is_file():
+                continue
+            stem = entry.name.rsplit('.', 1)[0]
+            mtime = entry.stat().st_mtime
+            if stem not in latest_files or mtime > latest_files[stem][1]:
+                latest_files[stem] = (Path(entry.path), mtime)
+    return sorted((file_path for file_path, _ in latest_files.values()), key=lambda file_path: file_path.name)
 
 def load_all_csv_from_dir(directory_path: Path) -> pd.DataFrame:
-    """Load all CSV files from a directory and combine them"""
+    """Load all CSV (or Parquet) files from a directory and combine them"""
     if not directory_path.exists():
         print(f"Error: Directory not found - {directory_path}")
         return pd.DataFrame()
@@ -18,73 +132,74 @@ def load_all_csv_from_dir(directory_path: Path) -> pd.DataFrame:
         print(f"Error: {directory_path} is not a directory")
         return pd.DataFrame()
     
-    # List all CSV files in the directory
-    csv_files = list(directory_path.glob('*.csv'))
+    # List all CSV and Parquet files in the directory
+    data_files = list_data_files(directory_path)
     
-    if not csv_files:
-        print(f"No CSV files found in {directory_path}")
+    if not data_files:
+        print(f"No CSV or Parquet files found in {directory_path}")
         return pd.DataFrame()
     
-    print(f"Found {len(csv_files)} CSV files in {directory_path}")
+    print(f"Found {len(data_files)} data files in {directory_path}")
     
-    # Load and combine all CSV files
-    all_data = []
-    for file_path in csv_files:
+    # Load all files as Arrow tables
+    all_tables = []
+    for file_path in data_files:
         try:
             # Explicitly check if file is accessible
             if not os.access(file_path, os.R_OK):
                 print(f"Permission denied accessing {file_path}")
                 continue
                 
-            df = pd.read_csv(file_path, low_memory=False)
-            
-            # Convert DateTime column to datetime if it exists - with better error handling
-            if 'DateTime' in df.columns:
-                try:
-                    # Try multiple datetime parsing approaches
-                    try:
-                        # First try the default parsing
-                        df['DateTime'] = pd.to_datetime(df['DateTime'])
-                    except:
-                        # If that fails, try with format='mixed' which is more flexible
-                        df['DateTime'] = pd.to_datetime(df['DateTime'], format='mixed')
-                except Exception as dt_error:
-                    print(f"  - Warning: DateTime conversion error in {file_path.name}: {str(dt_error)}")
-                    print(f"  - Attempting alternative datetime parsing...")
-                    
-                    # Try to handle timezone formats that might be causing issues
-                    df['DateTime'] = df['DateTime'].apply(lambda x: 
-                        pd.to_datetime(x.split('+')[0] if isinstance(x, str) and '+' in x else x)
-                    )
-            
-            # สำหรับคอลัมน์ที่มีชื่อลงท้ายด้วย _eda หรือ _ppg ให้ตรวจสอบรูปแบบข้อมูล
-            for col_suffix in ['_eda', '_ppg']:
-                for col_prefix in ['gender', 'type', 'sleep', 'bmi', 'bmi_category', 'id']:
-                    col_name = f"{col_prefix}{col_suffix}"
-                    if col_name in df.columns:
-                        # แน่ใจว่าข้อมูลในคอลัมน์เหล่านี้มีรูปแบบที่เหมาะสม
-                        if col_prefix in ['bmi', 'sleep']:
-                            # พยายามแปลงเป็นตัวเลขถ้าเป็นไปได้
-                            try:
-                                df[col_name] = pd.to_numeric(df[col_name], errors='coerce')
-                            except:
-                                pass
-            
-            print(f"  - Loaded {file_path.name}: {df.shape[0]} rows, {df.shape[1]} columns")
-            all_data.append(df)
+            table = load_data_file(file_path)
+            print(f"  - Loaded {file_path.name}: {table.num_rows} rows, {table.num_columns} columns")
+            all_tables.append(table)
         except Exception as e:
             print(f"  - Error loading {file_path.name}: {str(e)}")
     
-    if not all_data:
+    if not all_tables:
         print(f"No data could be loaded from {directory_path}")
         return pd.DataFrame()
     
-    # Combine all dataframes
-    combined_df = pd.concat(all_data, ignore_index=True)
+    # Combine all tables without copying rows, then convert to pandas only once
+    combined_table = all_tables[0] if len(all_tables) == 1 else pa.concat_tables(all_tables, promote_options='permissive')
+    combined_df = combined_table.to_pandas(self_destruct=True)
+    
     print(f"Combined data from {directory_path}: {combined_df.shape[0]} rows, {combined_df.shape[1]} columns")
     
     return combined_df
 
+@njit(cache=True)
+def find_nearest_indices(left_ns: np.ndarray, right_ns: np.ndarray, tolerance_ns: np.int64) -> np.ndarray:
+    """
+    Find the nearest right row for every left row (both sorted by time)
+    Returns -1 where the nearest timestamp is further away than the tolerance
+    """
+    n_left = left_ns.shape[0]
+    n_right = right_ns.shape[0]
+    right_idx = np.full(n_left, -1, dtype=np.int64)
+    j = -1
+    for i in range(n_left):
+        # เลื่อน j ไปยังแถวสุดท้ายที่เวลาไม่เกินเวลาของฝั่งซ้าย
+        while j + 1 < n_right and right_ns[j + 1] <= left_ns[i]:
+            j += 1
+        
+        # เลือกแถวที่ใกล้ที่สุดระหว่าง j กับ j + 1 (ถ้าเท่ากันให้ใช้แถวก่อนหน้าเหมือน merge_asof)
+        best = -1
+        best_diff = 0
+        if j >= 0:
+            best = j
+            best_diff = left_ns[i] - right_ns[j]
+        if j + 1 < n_right:
+            forward_diff = right_ns[j + 1] - left_ns[i]
+            if best == -1 or forward_diff < best_diff:
+                best = j + 1
+                best_diff = forward_diff
+        
+        if best != -1 and best_diff <= tolerance_ns:
+            right_idx[i] = best
+    
+    return right_idx
+
 def merge_eda_ppg(eda_df: pd.DataFrame, ppg_df: pd.DataFrame) -> pd.DataFrame:
     """Merge EDA and PPG data on DateTime and combine duplicate columns"""
     if eda_df.empty or ppg_df.empty:
@@ -107,12 +222,11 @@ def merge_eda_ppg(eda_df: pd.DataFrame, ppg_df: pd.DataFrame) -> pd.DataFrame:
         ('id_eda', 'id_ppg', 'id')
     ]
     
-    # เปลี่ยนชื่อคอลัมน์ก่อน merge ถ้ามีคอลัมน์นั้น
-    for eda_col, ppg_col, new_col in duplicate_columns:
-        if eda_col in eda_df.columns:
-            eda_df = eda_df.rename(columns={eda_col: f"{new_col}_eda"})
-        if ppg_col in ppg_df.columns:
-            ppg_df = ppg_df.rename(columns={ppg_col: f"{new_col}_ppg"})
+    # เปลี่ยนชื่อคอลัมน์ก่อน merge ถ้ามีคอลัมน์นั้น (rename ครั้งเดียวต่อ DataFrame)
+    eda_rename = {eda_col: f"{new_col}_eda" for eda_col, _, new_col in duplicate_columns if eda_col in eda_df.columns}
+    ppg_rename = {ppg_col: f"{new_col}_ppg" for _, ppg_col, new_col in duplicate_columns if ppg_col in ppg_df.columns}
+    eda_df = eda_df.rename(columns=eda_rename, copy=False)
+    ppg_df = ppg_df.rename(columns=ppg_rename, copy=False)
     
     # Standardize DateTime formats
     print("Standardizing DateTime formats...")
@@ -121,12 +235,20 @@ def merge_eda_ppg(eda_df: pd.DataFrame, ppg_df: pd.DataFrame) -> pd.DataFrame:
     eda_df['DateTime'] = pd.to_datetime(eda_df['DateTime'])
     ppg_df['DateTime'] = pd.to_datetime(ppg_df['DateTime'])
     
-    # Remove timezone info from both
-    if hasattr(eda_df['DateTime'].dt, 'tz'):
+    # Remove timezone info from both (only files written before DateTime became naive still have one)
+    if eda_df['DateTime'].dt.tz is not None:
         eda_df['DateTime'] = eda_df['DateTime'].dt.tz_localize(None)
-    if hasattr(ppg_df['DateTime'].dt, 'tz'):
+    if ppg_df['DateTime'].dt.tz is not None:
         ppg_df['DateTime'] = ppg_df['DateTime'].dt.tz_localize(None)
     
+    # Rows without a timestamp cannot be matched
+    for name, df in [('EDA', eda_df), ('PPG', ppg_df)]:
+        missing_dt = df['DateTime'].isna().sum()
+        if missing_dt:
+            print(f"Warning: Dropping {missing_dt} rows without DateTime in {name} data")
+    eda_df = eda_df.dropna(subset=['DateTime'])
+    ppg_df = ppg_df.dropna(subset=['DateTime'])
+    
     # Make sure DateTime is properly sorted
     eda_df = eda_df.sort_values('DateTime')
     ppg_df = ppg_df.sort_values('DateTime')
@@ -139,25 +261,43 @@ def merge_eda_ppg(eda_df: pd.DataFrame, ppg_df: pd.DataFrame) -> pd.DataFrame:
 
     # Merge using asof join to find nearest timestamps
     print("Performing merge...")
-    combined_df = pd.merge_asof(
-        eda_df,
-        ppg_df,
-        on='DateTime',
-        direction='nearest', 
-        tolerance=pd.Timedelta('1s'),
-        suffixes=('_eda', '_ppg')
-    )
+    eda_ns = eda_df['DateTime'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    ppg_ns = ppg_df['DateTime'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    ppg_idx = find_nearest_indices(eda_ns, ppg_ns, MERGE_TOLERANCE_NS)
+    
+    # คอลัมน์ที่ชื่อซ้ำกันให้เติม suffix เหมือน merge_asof
+    overlap_cols = [col for col in eda_df.columns if col != 'DateTime' and col in ppg_df.columns]
+    eda_part = eda_df.reset_index(drop=True).rename(columns={col: f"{col}_eda" for col in overlap_cols})
+    ppg_part = ppg_df.drop(columns='DateTime').reset_index(drop=True).rename(columns={col: f"{col}_ppg" for col in overlap_cols})
+    
+    # แถวที่ไม่มีคู่ (index -1) จะได้ค่า NaN จาก reindex
+    ppg_part = ppg_part.reindex(ppg_idx).set_axis(eda_part.index)
+    combined_df = pd.concat([eda_part, ppg_part], axis=1)
+    # pd.concat คัดลอกข้อมูลแล้ว ลบตัวแปรชั่วคราวเพื่อคืนหน่วยความจำก่อนรวมคอลัมน์ที่ซ้ำกัน
+    del eda_df, ppg_df, eda_part, ppg_part
 
     # รวมคอลัมน์ที่ซ้ำกัน
-    for _, _, new_col in duplicate_columns:
-        eda_col = f"{new_col}_eda"
-        ppg_col = f"{new_col}_ppg"
+    new_cols = [new_col for _, _, new_col in duplicate_columns
+                if f"{new_col}_eda" in combined_df.columns and f"{new_col}_ppg" in combined_df.columns]
+    if new_cols:
+        eda_cols = [f"{new_col}_eda" for new_col in new_cols]
+        ppg_cols = [f"{new_col}_ppg" for new_col in new_cols]
         
-        if eda_col in combined_df.columns and ppg_col in combined_df.columns:
-            # ใช้ค่าจาก EDA ก่อน ถ้าไม่มีค่าใน EDA ให้ใช้ค่าจาก PPG
-            combined_df[new_col] = combined_df[eda_col].fillna(combined_df[ppg_col])
-            # ลบคอลัมน์เดิม
-            combined_df = combined_df.drop(columns=[eda_col, ppg_col])
+        # ใช้ค่าจาก EDA ก่อน ถ้าไม่มีค่าใน EDA ให้ใช้ค่าจาก PPG (ทีละคู่คอลัมน์ เพื่อคง dtype เดิมไว้)
+        merged_columns = {}
+        for eda_col, ppg_col, new_col in zip(eda_cols, ppg_cols, new_cols):
+            eda_series = combined_df[eda_col]
+            ppg_series = combined_df[ppg_col]
+            if isinstance(eda_series.dtype, pd.CategoricalDtype) and isinstance(ppg_series.dtype, pd.CategoricalDtype):
+                # category ต้องมีชุดค่าเดียวกันก่อน fillna จึงจะยังเป็น category
+                categories = eda_series.cat.categories.union(ppg_series.cat.categories)
+                eda_series = eda_series.cat.set_categories(categories)
+                ppg_series = ppg_series.cat.set_categories(categories)
+            merged_columns[new_col] = eda_series.fillna(ppg_series)
+        
+        # ลบคอลัมน์เดิมทั้งหมดในครั้งเดียว
+        combined_df = pd.concat([combined_df.drop(columns=eda_cols + ppg_cols), pd.DataFrame(merged_columns)], axis=1)
+        for eda_col, ppg_col, new_col in zip(eda_cols, ppg_cols, new_cols):
             print(f"Combined columns: {eda_col} + {ppg_col} -> {new_col}")
     
     # Report on the results
@@ -168,6 +308,13 @@ def merge_eda_ppg(eda_df: pd.DataFrame, ppg_df: pd.DataFrame) -> pd.DataFrame:
     
     return combined_df
 
+def save_combined_data(df: pd.DataFrame, output_path: Path) -> None:
+    """Save combined data as Parquet or CSV depending on the file extension"""
+    if output_path.suffix == '.parquet':
+        df.to_parquet(output_path, engine='pyarrow', compression='zstd', use_dictionary=True, index=False)
+    else:
+        df.to_csv(output_path, index=False, float_format="%.6f")
+
 def main():
     """Main function to merge EDA and PPG data"""
     # Load all data from directories
@@ -180,6 +327,8 @@ def main():
     # Merge the data
     print("\n=== Merging datasets ===")
     combined_data = merge_eda_ppg(eda_data, ppg_data)
+    # ข้อมูลต้นฉบับไม่ใช้แล้ว คืนหน่วยความจำก่อนบันทึกไฟล์
+    del eda_data, ppg_data
 
     if combined_data.empty:
         print("No data to save. Exiting.")
@@ -201,23 +350,23 @@ def main():
     except PermissionError:
         print(f"WARNING: No write permission to {COMBINED_PATH}")
         # ลองใช้ชื่อไฟล์และตำแหน่งอื่น
-        output_path = Path(f'combined_eda_ppg_data.csv')
+        output_path = Path(f'combined_eda_ppg_data.{OUTPUT_FORMAT}')
         print(f"Trying to save to current directory instead: {output_path}")
     except Exception as e:
         print(f"Error testing write permission: {str(e)}")
 
     try:
         # Save the combined data
-        output_path = COMBINED_PATH / f'combined_eda_ppg_data.csv'
+        output_path = COMBINED_PATH / f'combined_eda_ppg_data.{OUTPUT_FORMAT}'
         print(f"Saving to: {output_path}")
-        combined_data.to_csv(output_path, index=False, float_format="%.6f")
+        save_combined_data(combined_data, output_path)
         print(f"Successfully saved merged data to {output_path}")
         print(f"   Rows: {combined_data.shape[0]}, Columns: {combined_data.shape[1]}")
     except PermissionError:
         # ถ้ายังไม่สามารถบันทึกได้ ลองบันทึกในไดเรกทอรีปัจจุบัน
-        fallback_path = Path(f'combined_eda_ppg_data.csv')
+        fallback_path = Path(f'combined_eda_ppg_data.{OUTPUT_FORMAT}')
         print(f"Permission denied. Saving to current directory instead: {fallback_path}")
-        combined_data.to_csv(fallback_path, index=False, float_format="%.6f")
+        save_combined_data(combined_data, fallback_path)
         print(f"Successfully saved merged data to {fallback_path}")
         print(f"   Rows: {combined_data.shape[0]}, Columns: {combined_data.shape[1]}")
     except Exception as e:
@@ -225,9 +374,9 @@ def main():
         print("Trying one last method to save data...")
         try:
             # ลองบันทึกในไดเรกทอรีที่โปรแกรมทำงานอยู่
-            desktop_path = Path.home() / "Desktop" / f'combined_eda_ppg_data.csv'
+            desktop_path = Path.home() / "Desktop" / f'combined_eda_ppg_data.{OUTPUT_FORMAT}'
             print(f"Saving to desktop: {desktop_path}")
-            combined_data.to_csv(desktop_path, index=False, float_format="%.6f")
+            save_combined_data(combined_data, desktop_path)
             print(f"Successfully saved merged data to {desktop_path}")
         except Exception as e2:
             print(f"All saving attempts failed: {str(e2)}")
@@ -1,9 +1,27 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
+import os
 
 PROCESSED_PATH = Path('Processed/eda')
 COMBINED_PATH = Path('Combined/eda')
+OUTPUT_FORMAT = 'parquet'  # ใช้ 'csv' ถ้าต้องการไฟล์ผลลัพธ์แบบเดิม
+
+def list_data_files(directory: Path) -> list:
+    """List processed CSV/Parquet files by name, using the newer file when a subject has both"""
+    if not directory.is_dir():
+        return []
+    latest_files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # ข้ามไฟล์ซ่อน (เช่นไฟล์ชั่วคราวของระบบ) ที่ไม่ใช่ผลลัพธ์จากขั้น process
+            if entry.name.startswith('.') or not entry.name.endswith(('.csv', '.parquet')) or not entry.is_file():
+                continue
+            stem = entry.name.rsplit('.', 1)[0]
+            mtime = entry.stat().st_mtime
+            if stem not in latest_files or mtime > latest_files[stem][1]:
+                latest_files[stem] = (Path(entry.path), mtime)
+    return sorted((file_path for file_path, _ in latest_files.values()), key=lambda file_path: file_path.name)
 
 # Concatenate all PPG files into a single DataFrame
 def concat_ppg_files(file_list: list) -> pd.DataFrame:
@@ -14,23 +32,32 @@ def concat_ppg_files(file_list: list) -> pd.DataFrame:
     # Iterate over each file in the list
     for file in file_list:
         # Load the PPG data from the file
-        ppg_data = pd.read_csv(file)
+        ppg_data = pd.read_parquet(file) if file.suffix == '.parquet' else pd.read_csv(file)
         
         # Append the DataFrame to the list
         dataframes.append(ppg_data)
     
-    # Concatenate all DataFrames in the list
-    combined_data = pd.concat(dataframes, ignore_index=True)
+    # Only one file, nothing to concatenate
+    if len(dataframes) == 1:
+        return dataframes[0]
+    
+    # ทุกไฟล์มาจาก eda-process.py จึงมีคอลัมน์และชนิดข้อมูลเหมือนกัน ต่อ array ของแต่ละคอลัมน์ได้โดยตรง
+    first = dataframes[0]
+    if all(tuple(df.columns) == tuple(first.columns) and df.dtypes.equals(first.dtypes) for df in dataframes):
+        return pd.DataFrame({col: np.concatenate([df[col].to_numpy() for df in dataframes]) for col in first.columns})
+    
+    # Concatenate all DataFrames in the list (without an extra copy of each block)
+    combined_data = pd.concat(dataframes, ignore_index=True, copy=False, sort=False)
     
     return combined_data
 
 def main():
     """Main function to concatenate all PPG files"""
     # Get list of files to concatenate
-    files = list(PROCESSED_PATH.glob('*.csv'))
+    files = list_data_files(PROCESSED_PATH)
     
     if not files:
-        print(f'No CSV files found in {PROCESSED_PATH}')
+        print(f'No CSV or Parquet files found in {PROCESSED_PATH}')
         return
         
     print(f'Found {len(files)} files to concatenate')
@@ -42,8 +69,11 @@ def main():
     COMBINED_PATH.mkdir(parents=True, exist_ok=True)
     
     # Save the combined data
-    output_path = COMBINED_PATH / 'combined_eda_data.csv'
-    combined_data.to_csv(output_path, index=False)
+    output_path = COMBINED_PATH / f'combined_eda_data.{OUTPUT_FORMAT}'
+    if OUTPUT_FORMAT == 'parquet':
+        combined_data.to_parquet(output_path, engine='pyarrow', compression='zstd', index=False)
+    else:
+        combined_data.to_csv(output_path, index=False)
     
     print(f'Successfully concatenated {len(files)} eda files')
 
@@ -1,46 +1,112 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from pathlib import Path
+import os
 
 PROCESSED_PATH = Path('Processed/ppg')
 COMBINED_PATH = Path('Combined/ppg')
-
-
-# กำหนด dtype ให้เป็น string ก่อนแล้วแปลงทีหลัง
+OUTPUT_FORMAT = 'parquet'  # ใช้ 'csv' ถ้าต้องการไฟล์ผลลัพธ์แบบเดิม
+
+# Multi-threaded Arrow CSV reader settings
+CSV_READ_OPTIONS = pacsv.ReadOptions(use_threads=True, block_size=8 << 20)
+# DateTime ไม่ต้องแปลง เก็บเป็น string เหมือนเดิม
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(column_types={'DateTime': pa.string()})
+
+
+def list_data_files(directory: Path) -> list:
+    """List processed CSV/Parquet files by name, using the newer file when a subject has both"""
+    if not directory.is_dir():
+        return []
+    latest_files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # ข้ามไฟล์ซ่อน (เช่นไฟล์ชั่วคราวของระบบ) ที่ไม่ใช่ผลลัพธ์จากขั้น process
+            if entry.name.startswith('.') or not entry.name.endswith(('.csv', '.parquet')) or not entry.is_file():
+                continue
+            stem = entry.name.rsplit('.', 1)[0]
+            mtime = entry.stat().st_mtime
+            if stem not in latest_files or mtime > latest_files[stem][1]:
+                latest_files[stem] = (Path(entry.path), mtime)
+    return sorted((file_path for file_path, _ in latest_files.values()), key=lambda file_path: file_path.name)
+
+
+def unify_column_types(tables: list) -> list:
+    """Cast columns read as text in one file and as numbers in another to string so the tables can be concatenated"""
+    column_types = {}
+    for table in tables:
+        for field in table.schema:
+            column_types.setdefault(field.name, set()).add(field.type)
+    text_columns = {name for name, types in column_types.items()
+                    if len(types) > 1 and any(pa.types.is_string(t) or pa.types.is_large_string(t) for t in types)}
+
+    unified_tables = []
+    for table in tables:
+        for i, field in enumerate(table.schema):
+            if field.name in text_columns and not pa.types.is_string(field.type):
+                table = table.set_column(i, field.name, pc.cast(table.column(i), pa.string()))
+        unified_tables.append(table)
+    return unified_tables
+
+
+# ให้ Arrow เดา dtype เองแล้วแปลงคอลัมน์ 16 และ 17 ทีหลัง
 def concat_ppg_files(file_list: list) -> pd.DataFrame:
     """Concatenate all PPG files into a single DataFrame"""
-    dataframes = []
+    tables = []
 
     for file in file_list:
         try:
-            ppg_data = pd.read_csv(file, dtype=str, low_memory=False)  # อ่านทุกคอลัมน์เป็น string
-            dataframes.append(ppg_data)
+            if file.suffix == '.parquet':
+                ppg_data = pq.read_table(file)
+            else:
+                ppg_data = pacsv.read_csv(file, read_options=CSV_READ_OPTIONS, convert_options=CSV_CONVERT_OPTIONS)
+            tables.append(ppg_data)
         except Exception as e:
             print(f"Error reading {file}: {e}")
 
-    if not dataframes:
+    if not tables:
         print("No valid dataframes to concatenate.")
         return pd.DataFrame()
 
-    combined_data = pd.concat(dataframes, ignore_index=True)
+    if len(tables) == 1:
+        combined_table = tables[0]
+    elif all(table.schema.equals(tables[0].schema) for table in tables):
+        # schema เหมือนกันทุกไฟล์ ต่อ chunk กันได้ทันทีโดยไม่ต้องปรับ schema
+        combined_table = pa.concat_tables(tables)
+    else:
+        # Arrow เดา dtype แยกกันทีละไฟล์ คอลัมน์เดียวกันอาจเป็นตัวเลขในไฟล์หนึ่งแต่เป็น string ในอีกไฟล์
+        combined_table = pa.concat_tables(unify_column_types(tables), promote_options='permissive')
 
     # แปลงคอลัมน์ 16 และ 17 ให้เป็น numeric (ถ้าเป็นไปได้)
     cols_to_convert = [16, 17]
+    text_cols = []
     for col in cols_to_convert:
-        col_name = combined_data.columns[col] if col < len(combined_data.columns) else None
-        if col_name:
-            combined_data[col_name] = pd.to_numeric(combined_data[col_name],
-                                                    errors='coerce')  # แปลงค่าที่เป็นตัวเลข ถ้าไม่ได้ให้เป็น NaN
+        if col >= combined_table.num_columns:
+            continue
+        field = combined_table.schema.field(col)
+        if pa.types.is_integer(field.type) or pa.types.is_floating(field.type) or pa.types.is_null(field.type):
+            combined_table = combined_table.set_column(col, field.name, pc.cast(combined_table.column(col), pa.float64()))
+        else:
+            # Arrow อ่านเป็น string แสดงว่ามีค่าที่ไม่ใช่ตัวเลข ให้ pandas แปลงเป็น NaN แทน
+            text_cols.append(field.name)
+
+    combined_data = combined_table.to_pandas(self_destruct=True)
+    for col_name in text_cols:
+        combined_data[col_name] = pd.to_numeric(combined_data[col_name],
+                                                errors='coerce')  # แปลงค่าที่เป็นตัวเลข ถ้าไม่ได้ให้เป็น NaN
 
     return combined_data
 
 
 def main():
     """Main function to concatenate all PPG files"""
-    files = list(PROCESSED_PATH.glob('*.csv'))
+    files = list_data_files(PROCESSED_PATH)
 
     if not files:
-        print(f'No CSV files found in {PROCESSED_PATH}')
+        print(f'No CSV or Parquet files found in {PROCESSED_PATH}')
         return
 
     print(f'Found {len(files)} files to concatenate')
@@ -53,10 +119,13 @@ def main():
 
     COMBINED_PATH.mkdir(parents=True, exist_ok=True)
 
-    output_path = COMBINED_PATH / 'combined_ppg_data.csv'
+    output_path = COMBINED_PATH / f'combined_ppg_data.{OUTPUT_FORMAT}'
 
     try:
-        combined_data.to_csv(output_path, index=False)
+        if OUTPUT_FORMAT == 'parquet':
+            combined_data.to_parquet(output_path, engine='pyarrow', compression='zstd', index=False)
+        else:
+            combined_data.to_csv(output_path, index=False)
         print(f'Successfully concatenated {len(files)} PPG files and saved to {output_path}')
     except Exception as e:
         print(f"Error saving file: {e}")
@@ -16,22 +16,35 @@ OUTPUT_PATH = Path('Output/Before_label')
 # Create target directory if it doesn't exist
 COMBINED_PATH.mkdir(parents=True, exist_ok=True)
 
+def list_data_files(directory: Path) -> list:
+    """List CSV and Parquet files in a directory (sorted by name), keeping the newer file when both formats exist"""
+    latest_files = {}
+    for data_file in list(directory.glob('*.csv')) + list(directory.glob('*.parquet')):
+        # ไฟล์ CSV เก่าจากรุ่นก่อนอาจยังอยู่คู่กับไฟล์ Parquet ใหม่ ให้ใช้ไฟล์ที่ใหม่กว่าเท่านั้น
+        mtime = data_file.stat().st_mtime
+        if data_file.stem not in latest_files or mtime > latest_files[data_file.stem][1]:
+            latest_files[data_file.stem] = (data_file, mtime)
+    return sorted((data_file for data_file, _ in latest_files.values()), key=lambda data_file: data_file.name)
+
 def load_all_csv_from_dir(directory: Path) -> pd.DataFrame:
-    """Load all CSV files from directory and combine them into a single DataFrame"""
+    """Load all CSV (or Parquet) files from directory and combine them into a single DataFrame"""
     print(f"Loading CSV files from {directory}")
     
     # Create empty DataFrame
     df = pd.DataFrame()
     
-    # Get list of CSV files
-    csv_files = list(directory.glob('*.csv'))
+    # Get list of CSV files (Combined_eapg.py writes Parquet by default)
+    csv_files = list_data_files(directory)
     print(f"Found {len(csv_files)} CSV files")
     
     # Process each CSV file
     for csv_file in csv_files:
         print(f"Processing {csv_file.name}")
         try:
-            temp_df = pd.read_csv(csv_file)
+            if csv_file.suffix == '.parquet':
+                temp_df = pd.read_parquet(csv_file)
+            else:
+                temp_df = pd.read_csv(csv_file)
             print(f"  - Loaded {len(temp_df)} rows")
             
             # Check for empty values
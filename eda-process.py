@@ -5,6 +5,9 @@ import glob
 from pathlib import Path
 from datetime import datetime
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from numba import njit
 
 def load_json(file_path: Path) -> dict:
     """Load JSON file"""
@@ -14,9 +17,13 @@ def load_json(file_path: Path) -> dict:
 
 # Constants
 SAMPLING_RATE = 15
+RESAMPLE_NS = 1_000_000_000  # 1 second resampling bucket in nanoseconds
+BANGKOK_OFFSET_NS = 7 * 3600 * 1_000_000_000  # Asia/Bangkok is always UTC+7 (no daylight saving)
 RAW_PATH = Path('Raw/eda')
 PROCESSED_PATH = Path('Processed/eda')
+OUTPUT_FORMAT = 'parquet'  # ใช้ 'csv' ถ้าต้องการไฟล์ผลลัพธ์แบบเดิม
 Label = load_json("label.json")
+LABEL_BY_ID = {label['id'].upper(): label for label in Label}
 
 
 def process_timestamp(df: pd.DataFrame) -> pd.DataFrame:
@@ -29,8 +36,12 @@ def process_timestamp(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         DataFrame with corrected timestamps
     """
-    # Convert Unix timestamp to datetime
-    df['DateTime'] = pd.to_datetime(df['LocalTimestamp'] , unit='s').dt.tz_localize('UTC').dt.tz_convert('Asia/Bangkok')
+    # Convert Unix timestamp to Bangkok local time with integer arithmetic
+    # (seconds and fraction are split the same way pd.to_datetime(unit='s') does)
+    timestamps = df['LocalTimestamp'].to_numpy(dtype=np.float64)
+    seconds = timestamps.astype(np.int64)
+    fraction_ns = (np.round(timestamps - seconds, 9) * 1_000_000_000).astype(np.int64)
+    df['DateTime'] = pd.DatetimeIndex(seconds * 1_000_000_000 + fraction_ns + BANGKOK_OFFSET_NS)
 
     
     return df
@@ -40,14 +51,59 @@ def get_subject_id_from_filename(filename: str) -> str:
     # Convert to uppercase to match label.json format
     return filename.split('_')[0].upper()
 
-def get_label_for_subject(subject_id: str, labels: list) -> dict:
+def get_label_for_subject(subject_id: str) -> dict:
     """Get label information for a specific subject"""
     # Convert input subject_id to uppercase for comparison
-    subject_id = subject_id.upper()
-    for label in labels:
-        if label['id'].upper() == subject_id:
-            return label
-    return None
+    return LABEL_BY_ID.get(subject_id.upper())
+
+@njit(cache=True)
+def bucket_mean(bucket_ids: np.ndarray, values: np.ndarray, n_buckets: int) -> np.ndarray:
+    """Average each column per bucket, skipping NaN (empty buckets become NaN)"""
+    n_rows, n_cols = values.shape
+    result = np.empty((n_buckets, n_cols))
+    # ไฟล์ถูกแบ่งไปหลาย process อยู่แล้ว จึงวนทีละคอลัมน์ใน thread เดียว
+    for col in range(n_cols):
+        sums = np.zeros(n_buckets)
+        counts = np.zeros(n_buckets, dtype=np.int64)
+        for i in range(n_rows):
+            value = values[i, col]
+            if not np.isnan(value):
+                sums[bucket_ids[i]] += value
+                counts[bucket_ids[i]] += 1
+        for b in range(n_buckets):
+            result[b, col] = sums[b] / counts[b] if counts[b] > 0 else np.nan
+    return result
+
+def get_bucket_ids(index: pd.DatetimeIndex, bucket_ns: int = RESAMPLE_NS) -> tuple:
+    """Map every timestamp to a fixed time bucket, returns (bucket_ids, bucket_index)"""
+    ts_ns = index.asi8
+    # ขอบของ bucket ตรงกับวินาทีเต็มเหมือน pandas resample
+    first_bucket = (ts_ns.min() // bucket_ns) * bucket_ns
+    bucket_ids = (ts_ns - first_bucket) // bucket_ns
+    n_buckets = int(bucket_ids.max()) + 1
+    
+    bucket_index = pd.DatetimeIndex(first_bucket + np.arange(n_buckets, dtype=np.int64) * bucket_ns)
+    if index.tz is not None:
+        bucket_index = bucket_index.tz_localize('UTC').tz_convert(index.tz)
+    bucket_index.name = index.name
+    return bucket_ids, bucket_index
+
+def resample_mean(df: pd.DataFrame, bucket_ids: np.ndarray, bucket_index: pd.DatetimeIndex) -> pd.DataFrame:
+    """
+    Average the rows of every bucket from get_bucket_ids
+    Same result as df.resample('1s').mean() for numeric columns
+    """
+    values = df.to_numpy(dtype=np.float64)
+    result = bucket_mean(bucket_ids, values, len(bucket_index))
+    return pd.DataFrame(result, index=bucket_index, columns=df.columns)
+
+def resample_first(df: pd.DataFrame, bucket_ids: np.ndarray, bucket_index: pd.DatetimeIndex) -> pd.DataFrame:
+    """
+    First non-null value of every bucket from get_bucket_ids
+    Same result as df.resample('1s').first()
+    """
+    result = df.groupby(bucket_ids).first()
+    return result.reindex(np.arange(len(bucket_index))).set_axis(bucket_index)
 
 # Resampling ข้อมูลเป็นทุก 1 วินาที
 def process_eda_file(file_path: Path) -> None:
@@ -55,7 +111,7 @@ def process_eda_file(file_path: Path) -> None:
     try:
         # Get subject ID and corresponding label
         subject_id = get_subject_id_from_filename(file_path.name)
-        subject_label = get_label_for_subject(subject_id, Label)
+        subject_label = get_label_for_subject(subject_id)
         
         if not subject_label:
             print(f"Warning: No label found for subject {subject_id}")
@@ -63,46 +119,44 @@ def process_eda_file(file_path: Path) -> None:
             
         # Load and clean data
         data = pd.read_csv(file_path)
-        data = data.dropna().reset_index(drop=True)
+        # ตัดเฉพาะแถวที่ไม่มีเวลาหรือค่า EA (คอลัมน์อื่นไม่ได้ใช้)
+        data = data.dropna(subset=['LocalTimestamp', 'EA']).reset_index(drop=True)
         
         # Process timestamp
         data = process_timestamp(data)
         
         # Process PPG signal
         signals, info = nk.eda_process(data['EA'], sampling_rate=SAMPLING_RATE)
-        signals = pd.DataFrame(signals)
-        
-        # เพิ่ม DateTime จาก data เดิม
-        signals['DateTime'] = data['DateTime']
         
         if len(signals) != len(data):
             print(f"Warning: Length mismatch in {file_path.name}")
             return
         
-        # ตั้งค่า DateTime เป็น index สำหรับการ resample
-        signals.set_index('DateTime', inplace=True)
+        # ใช้ DateTime จาก data เดิมเป็น index สำหรับการ resample (ไม่ต้องคัดลอกข้อมูลใน signals)
+        signals.index = pd.DatetimeIndex(data['DateTime'])
         
-        # แยกคอลัมน์ที่เป็นข้อความ (object) ก่อน resample
-        object_cols = {}
-        for col in signals.columns:
-            if signals[col].dtype == 'object':
-                # เก็บค่าแรกของแต่ละคอลัมน์ที่เป็น object ไว้
-                object_cols[col] = signals[col].iloc[0]
+        # แยกคอลัมน์ตัวเลขและคอลัมน์ข้อความ (object) จาก dtypes ในครั้งเดียว
+        dtypes = signals.dtypes
+        is_numeric = np.array([dtype.kind in 'biuf' for dtype in dtypes], dtype=bool)
+        numeric_cols = dtypes.index[is_numeric].tolist()
+        object_cols = dtypes.index[~is_numeric].tolist()
         
-        # ทำ resampling เฉพาะข้อมูลตัวเลข
-        resampled_data = signals.resample('1s').mean()
+        # ทำ resampling เฉพาะข้อมูลตัวเลข (ใช้ bucket ชุดเดียวกันกับคอลัมน์ข้อความ)
+        bucket_ids, bucket_index = get_bucket_ids(signals.index)
+        numeric_signals = signals[numeric_cols] if object_cols else signals
+        resampled_data = resample_mean(numeric_signals, bucket_ids, bucket_index)
         
         # เติมค่า NaN ที่อาจเกิดจากการ resample ด้วยการ forward fill
         # ใช้ ffill() แทน fillna(method='ffill') ตามคำแนะนำ
         resampled_data = resampled_data.ffill()
         
-        # ใส่ข้อมูล label กลับไปยัง DataFrame หลัง resample
-        for key, value in subject_label.items():
-            resampled_data[key] = value
-            
-        # ใส่ข้อมูล object columns กลับไป
-        for col, value in object_cols.items():
-            resampled_data[col] = value
+        # ใส่ข้อมูล label กลับไปยัง DataFrame หลัง resample ในครั้งเดียว
+        resampled_data = resampled_data.assign(**subject_label)
+        
+        # object columns ใช้ค่าแรกของแต่ละวินาที (index ตรงกับข้อมูลที่ resample แล้ว ไม่ต้อง broadcast)
+        if object_cols:
+            resampled_data = resampled_data.join(resample_first(signals[object_cols], bucket_ids, bucket_index).ffill(),
+                                                 rsuffix='_signal')
         
         # Reset index เพื่อทำให้ DateTime กลับเป็นคอลัมน์
         resampled_data.reset_index(inplace=True)
@@ -111,8 +165,11 @@ def process_eda_file(file_path: Path) -> None:
         PROCESSED_PATH.mkdir(parents=True, exist_ok=True)
         
         # Save processed data
-        output_path = PROCESSED_PATH / file_path.name
-        resampled_data.to_csv(output_path, index=False)
+        output_path = (PROCESSED_PATH / file_path.name).with_suffix(f'.{OUTPUT_FORMAT}')
+        if OUTPUT_FORMAT == 'parquet':
+            resampled_data.to_parquet(output_path, engine='pyarrow', compression='zstd', index=False)
+        else:
+            resampled_data.to_csv(output_path, index=False)
         print(f'Successfully processed {file_path.name} for subject {subject_id}')
         
     except Exception as e:
@@ -131,9 +188,9 @@ def main():
         
     print(f'Found {len(files)} files to process')
     
-    # Process each file
-    for file_path in files:
-        process_eda_file(file_path)
+    # Process files in parallel (each file is independent)
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(files))) as executor:
+        list(executor.map(process_eda_file, files, chunksize=1))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -5,12 +5,17 @@ import glob
 from pathlib import Path
 from datetime import datetime, timedelta
 import json
+import matplotlib
+matplotlib.use('Agg')  # plots are only saved to files, so worker processes need no display
 import matplotlib.pyplot as plt
 import traceback
 import time
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from numba import njit
+import scipy.interpolate
+import scipy.signal
 
 
 def load_json(file_path: Path) -> dict:
@@ -25,10 +30,18 @@ SAMPLING_RATE = 100
 WINDOW_SIZE = 300  # 5 minutes (300 seconds)
 WINDOW_SHIFT = 1  # Shift by 5 seconds for each window (increased from 1 for speed)
 WINDOW_SAMPLES = WINDOW_SIZE * SAMPLING_RATE  # Number of samples in a window
+BANGKOK_OFFSET_NS = 7 * 3600 * 1_000_000_000  # Asia/Bangkok is always UTC+7 (no daylight saving)
+# Frequency bands (Hz) and RR interpolation rate, same defaults as nk.hrv_frequency
+HRV_BANDS = {'ULF': (0, 0.0033), 'VLF': (0.0033, 0.04), 'LF': (0.04, 0.15), 'HF': (0.15, 0.4), 'VHF': (0.4, 0.5)}
+HRV_INTERPOLATION_RATE = 100
 RAW_PATH = Path('Raw/ppg')
 PROCESSED_PATH = Path('Processed/ppg')
+PPG_COLUMN_KEYWORDS = ['ppg', 'pg', 'photoplethysmography', 'pulse']
+OUTPUT_FORMAT = 'parquet'  # ใช้ 'csv' ถ้าต้องการไฟล์ผลลัพธ์แบบเดิม
+CSV_FLOAT_FORMAT = '%.7g'  # float32 keeps about 7 significant digits
 ENABLE_PLOTS = False  # Set to False to disable plotting for better performance
 Label = load_json("label.json")
+LABEL_BY_ID = {label.get('id', '').upper(): label for label in Label}
 
 
 def process_timestamp(df: pd.DataFrame) -> pd.DataFrame:
@@ -42,31 +55,271 @@ def process_timestamp(df: pd.DataFrame) -> pd.DataFrame:
         sample_timestamp = df['LocalTimestamp'].iloc[0]
         print(f"Original timestamp: {sample_timestamp}")
         
-        # Convert timestamp to datetime correctly
-        # For Unix timestamps (seconds since epoch)
-        df['DateTime'] = pd.to_datetime(df['LocalTimestamp'], unit='s')
-        
-        # Add Thailand timezone (+7) - uncomment and use this line
-        #df['DateTime'] = df['DateTime'] + pd.Timedelta(hours=7)
-        # หรือใช้คำสั่งนี้เพื่อระบุเขตเวลา
-        df['DateTime'] = df['DateTime'].dt.tz_localize('UTC').dt.tz_convert('Asia/Bangkok').dt.tz_localize(None)
+        # Convert Unix timestamp (seconds since epoch) to naive Bangkok local time with integer arithmetic
+        # (seconds and fraction are split the same way pd.to_datetime(unit='s') does)
+        timestamps = df['LocalTimestamp'].to_numpy(dtype=np.float64)
+        # ค่าที่ไม่ใช่ตัวเลข (NaN/inf) ต้องเป็น NaT เหมือน pd.to_datetime ไม่ใช่ปี 1677
+        valid = np.isfinite(timestamps)
+        timestamps = np.where(valid, timestamps, 0.0)
+        seconds = timestamps.astype(np.int64)
+        fraction_ns = (np.round(timestamps - seconds, 9) * 1_000_000_000).astype(np.int64)
+        datetime_ns = np.where(valid, seconds * 1_000_000_000 + fraction_ns + BANGKOK_OFFSET_NS, np.iinfo(np.int64).min)
+        df['DateTime'] = pd.DatetimeIndex(datetime_ns.view('datetime64[ns]'))
         
         print(f"Converted first timestamp: {df['DateTime'].iloc[0]}")
     
     return df
 
+def read_ppg_csv(file_path: Path) -> pd.DataFrame:
+    """Read only the timestamp and PPG signal columns of a raw PPG file"""
+    # อ่านเฉพาะหัวตารางก่อนเพื่อหาชื่อคอลัมน์ PPG
+    columns = pd.read_csv(file_path, nrows=0).columns
+    ppg_columns = [col for col in columns if any(ppg in col.lower() for ppg in PPG_COLUMN_KEYWORDS)]
+    if not ppg_columns:
+        # No obvious PPG column, keep everything for the best-guess fallback
+        return pd.read_csv(file_path)
+
+    ppg_column = ppg_columns[0]
+    usecols = [col for col in ['LocalTimestamp', 'DateTime'] if col in columns] + [ppg_column]
+    dtype = {ppg_column: 'float32'}
+    if 'LocalTimestamp' in columns:
+        dtype['LocalTimestamp'] = 'float64'
+    try:
+        return pd.read_csv(file_path, usecols=usecols, dtype=dtype, engine='pyarrow')
+    except Exception:
+        # มีค่าที่ไม่ใช่ตัวเลข ให้อ่านแบบเดิมแล้วแปลงทีหลัง
+        return pd.read_csv(file_path, usecols=usecols)
+
+
+def save_processed_data(df: pd.DataFrame, output_path: Path) -> None:
+    """Save the window results as Parquet or CSV depending on the file suffix"""
+    if output_path.suffix == '.parquet':
+        # DateTime เป็นคอลัมน์แรกเหมือนไฟล์ CSV (concat-ppg อ้างคอลัมน์ตามตำแหน่ง)
+        df.reset_index().to_parquet(output_path, engine='pyarrow', compression='zstd', index=False)
+    else:
+        df.to_csv(output_path, index=True, float_format=CSV_FLOAT_FORMAT)
+
+
 def get_subject_id_from_filename(filename: str) -> str:
     """Extract subject ID from filename"""
     return filename.split('_')[0].upper()
 
 
-def get_label_for_subject(subject_id: str, labels: list) -> dict:
+def get_label_for_subject(subject_id: str) -> dict:
     """Get label for a specific subject"""
-    subject_id = subject_id.upper()
-    for label in labels:
-        if label.get('id', '').upper() == subject_id:
-            return label
-    return None
+    return LABEL_BY_ID.get(subject_id.upper())
+
+
+@njit(cache=True)
+def find_window_peak_bounds(peak_indices, window_starts, window_ends):
+    """
+    Find the [lo, hi) range of peak positions inside each window
+    peak_indices, window_starts and window_ends must all be sorted
+    """
+    n_peaks = peak_indices.shape[0]
+    n_windows = window_starts.shape[0]
+    peak_lo = np.empty(n_windows, dtype=np.int64)
+    peak_hi = np.empty(n_windows, dtype=np.int64)
+    lo = 0
+    hi = 0
+    for w in range(n_windows):
+        # Both cursors only move forward, so all windows take a single pass over the peaks
+        while lo < n_peaks and peak_indices[lo] < window_starts[w]:
+            lo += 1
+        if hi < lo:
+            hi = lo
+        while hi < n_peaks and peak_indices[hi] < window_ends[w]:
+            hi += 1
+        peak_lo[w] = lo
+        peak_hi[w] = hi
+    return peak_lo, peak_hi
+
+
+def window_means(values, window_starts, window_ends, block_size=SAMPLING_RATE):
+    """
+    Mean of values over every [start, end) window using cumulative sums of per-block sums
+    Window bounds must fall on block boundaries (or the end of the data)
+    NaN values are skipped, the same as pandas Series.mean()
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    # Centre the values so the running sum stays small and keeps its precision
+    offset = values[valid].mean() if valid.any() else 0.0
+    # รวมค่าเป็นช่วงละ 1 วินาทีก่อน แล้วหาผลรวมสะสมจากช่วงเหล่านั้นแทนทุก sample
+    block_edges = np.arange(0, len(values), block_size)
+    block_sums = np.add.reduceat(np.where(valid, values - offset, 0.0), block_edges)
+    block_counts = np.add.reduceat(valid.astype(np.int64), block_edges)
+    cs_values = np.concatenate(([0.0], np.cumsum(block_sums)))
+    cs_count = np.concatenate(([0], np.cumsum(block_counts)))
+    block_starts = window_starts // block_size
+    block_ends = -(-window_ends // block_size)
+    count = cs_count[block_ends] - cs_count[block_starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (cs_values[block_ends] - cs_values[block_starts]) / count + offset
+    means[count == 0] = np.nan
+    return means
+
+
+@njit(cache=True)
+def kahan_add(total, compensation, value):
+    """Add value to a running total with Kahan compensation, returns (total, compensation)"""
+    y = value - compensation
+    t = total + y
+    return t, (t - total) - y
+
+
+@njit(cache=True)
+def window_rr_stats(peak_indices, peak_lo, peak_hi, sampling_rate):
+    """
+    HR, RR_Mean, RMSSD and SDNN of the peaks in every window in one streaming pass
+    peak_lo/peak_hi are the [lo, hi) peak ranges from find_window_peak_bounds (both non-decreasing)
+    """
+    # RR intervals (ms) between consecutive peaks, rr[k] = peak k -> k + 1
+    rr = np.diff(peak_indices) / sampling_rate * 1000
+    # ลบค่าอ้างอิงออกก่อนรวม เพื่อไม่ให้เสียความแม่นยำของค่าความแปรปรวน
+    rr_offset = rr[0] if rr.shape[0] > 0 else 0.0
+
+    n_windows = peak_lo.shape[0]
+    hr = np.full(n_windows, np.nan)
+    rr_mean = np.full(n_windows, np.nan)
+    rmssd = np.full(n_windows, np.nan)
+    sdnn = np.full(n_windows, np.nan)
+
+    # Current RR range [rr_a, rr_b) and successive-difference range [drr_a, drr_b) with their running sums
+    rr_a = 0
+    rr_b = 0
+    drr_a = 0
+    drr_b = 0
+    s = 0.0
+    s_comp = 0.0
+    s2 = 0.0
+    s2_comp = 0.0
+    ssd = 0.0
+    ssd_comp = 0.0
+    n_rr_total = rr.shape[0]
+    for w in range(n_windows):
+        lo = peak_lo[w]
+        # A window with n peaks has n - 1 RR intervals and n - 2 successive differences
+        # (clamped so empty or single-peak windows at the end of the record stay inside rr)
+        rr_end = min(max(lo, peak_hi[w] - 1), n_rr_total)
+        drr_end = min(max(lo, peak_hi[w] - 2), max(n_rr_total - 1, 0))
+
+        # Add the intervals entering the window, then drop the ones that left it
+        while rr_b < rr_end:
+            value = rr[rr_b] - rr_offset
+            s, s_comp = kahan_add(s, s_comp, value)
+            s2, s2_comp = kahan_add(s2, s2_comp, value * value)
+            rr_b += 1
+        while rr_a < lo and rr_a < rr_b:
+            value = rr[rr_a] - rr_offset
+            s, s_comp = kahan_add(s, s_comp, -value)
+            s2, s2_comp = kahan_add(s2, s2_comp, -value * value)
+            rr_a += 1
+        while drr_b < drr_end:
+            diff = rr[drr_b + 1] - rr[drr_b]
+            ssd, ssd_comp = kahan_add(ssd, ssd_comp, diff * diff)
+            drr_b += 1
+        while drr_a < lo and drr_a < drr_b:
+            diff = rr[drr_a + 1] - rr[drr_a]
+            ssd, ssd_comp = kahan_add(ssd, ssd_comp, -diff * diff)
+            drr_a += 1
+
+        n_rr = rr_b - rr_a
+        n_drr = drr_b - drr_a
+        # เริ่มผลรวมใหม่เมื่อช่วงว่าง เพื่อไม่ให้เศษจากการลบสะสมไปหน้าต่างถัดไป
+        # (ช่วง successive difference อยู่ในช่วง RR เสมอ จึงต้องล้างก่อนเช็ค n_rr)
+        if n_drr == 0:
+            ssd = 0.0
+            ssd_comp = 0.0
+        if n_rr == 0:
+            s = 0.0
+            s_comp = 0.0
+            s2 = 0.0
+            s2_comp = 0.0
+            continue
+
+        shifted_mean = s / n_rr
+        rr_mean[w] = shifted_mean + rr_offset
+        if rr_mean[w] > 0:
+            hr[w] = 60000 / rr_mean[w]
+        sdnn[w] = np.sqrt(max(s2 / n_rr - shifted_mean * shifted_mean, 0.0))
+        if n_drr > 0:
+            rmssd[w] = np.sqrt(max(ssd, 0.0) / n_drr)
+    return hr, rr_mean, rmssd, sdnn
+
+
+@lru_cache(maxsize=4)
+def ppg_bandpass_sos(sampling_rate: int) -> np.ndarray:
+    """Butterworth band-pass (0.5-8 Hz, order 3) used by NeuroKit's elgendi PPG cleaning"""
+    return scipy.signal.butter(3, [0.5, 8], btype='bandpass', output='sos', fs=sampling_rate)
+
+
+def process_ppg_signal(ppg_signal: pd.Series, sampling_rate: int) -> pd.DataFrame:
+    """
+    Clean the PPG signal and find its peaks, rate and quality
+    Same output as nk.ppg_process with its default methods, but reuses the designed filter
+    """
+    ppg_values = ppg_signal.to_numpy()
+    if np.isnan(ppg_values).any():
+        # ให้ NeuroKit เติมค่าที่หายไปเองตามวิธีเดิม
+        signals, _ = nk.ppg_process(ppg_signal, sampling_rate=sampling_rate)
+        return signals
+
+    ppg_cleaned = scipy.signal.sosfiltfilt(ppg_bandpass_sos(sampling_rate), ppg_values)
+    peaks = nk.ppg_findpeaks(ppg_cleaned, sampling_rate=sampling_rate, method='elgendi')['PPG_Peaks']
+    rate = nk.signal_rate(peaks, sampling_rate=sampling_rate, desired_length=len(ppg_cleaned))
+    quality = nk.ppg_quality(ppg_cleaned, ppg_pw_peaks=peaks, sampling_rate=sampling_rate, method='templatematch')
+    peak_signal = np.zeros(len(ppg_cleaned), dtype=np.int64)
+    peak_signal[peaks] = 1
+    return pd.DataFrame({
+        'PPG_Raw': ppg_values,
+        'PPG_Clean': ppg_cleaned,
+        'PPG_Rate': rate,
+        'PPG_Quality': quality,
+        'PPG_Peaks': peak_signal,
+    })
+
+
+def hrv_frequency_welch(peaks, sampling_rate, interpolation_rate=HRV_INTERPOLATION_RATE):
+    """
+    Frequency-domain HRV metrics from a single Welch PSD of the interpolated RR series
+    Gives the same values as nk.hrv_frequency with its default settings, without the DataFrame overhead
+    """
+    # RR intervals (ms) at the time of each beat (s)
+    rri = np.diff(peaks) / sampling_rate * 1000
+    rri_time = np.cumsum(rri / 1000)
+    x_new = np.arange(rri_time[0], rri_time[-1] + 1 / interpolation_rate, 1 / interpolation_rate)
+    rri_interp = scipy.interpolate.interp1d(rri_time, rri, kind='quadratic', bounds_error=False,
+                                            fill_value=([rri[0]], [rri[-1]]))(x_new)
+    rri_interp = rri_interp - np.mean(rri_interp)
+
+    # Welch window long enough for the lowest resolvable frequency (at most half the signal)
+    n = len(rri_interp)
+    min_frequency = (2 * interpolation_rate) / (n / 2)
+    nperseg = int((2 / min_frequency) * interpolation_rate)
+    if nperseg > n / 2:
+        nperseg = int(n / 2)
+    frequency, power = scipy.signal.welch(rri_interp, fs=interpolation_rate, scaling='density', detrend=False,
+                                          nfft=int(nperseg * 2), average='mean', nperseg=nperseg, window='hann')
+    power = power / np.max(power)
+    in_range = (frequency >= min_frequency) & (frequency <= HRV_BANDS['VHF'][1])
+    frequency = frequency[in_range]
+    power = power[in_range]
+
+    # พลังงานในแต่ละช่วงความถี่ (ช่วงที่ไม่มีข้อมูลเป็น NaN)
+    hrv_freq = {}
+    for band_name, (low, high) in HRV_BANDS.items():
+        in_band = (frequency >= low) & (frequency < high)
+        band_power = np.trapezoid(power[in_band], frequency[in_band])
+        hrv_freq[f'HRV_{band_name}'] = np.nan if band_power == 0.0 else band_power
+
+    total_power = np.nansum(list(hrv_freq.values()))
+    hrv_freq['HRV_TP'] = total_power
+    hrv_freq['HRV_LFHF'] = hrv_freq['HRV_LF'] / hrv_freq['HRV_HF']
+    hrv_freq['HRV_LFn'] = hrv_freq['HRV_LF'] / total_power
+    hrv_freq['HRV_HFn'] = hrv_freq['HRV_HF'] / total_power
+    hrv_freq['HRV_LnHF'] = np.log(hrv_freq['HRV_HF'])
+    return hrv_freq
 
 
 def calculate_hrv_metrics(peaks, sampling_rate, minimal=False):
@@ -115,7 +368,7 @@ def calculate_hrv_metrics(peaks, sampling_rate, minimal=False):
         # Calculate frequency-domain HRV metrics if enough peaks
         if len(peaks) >= 30:  # Frequency domain needs more peaks
             try:
-                hrv_freq = nk.hrv_frequency(peaks, sampling_rate=sampling_rate, show=False)
+                hrv_freq = pd.DataFrame([hrv_frequency_welch(peaks, sampling_rate)])
             except Exception as e:
                 print(f"Warning: Frequency-domain HRV calculation failed: {e}")
                 hrv_freq = pd.DataFrame(index=[0])  # Empty DataFrame with same structure
@@ -165,24 +418,21 @@ def process_ppg_file(file_path: Path) -> None:
         # --- 1. Data Loading and Preprocessing ---
         # Get subject identification and label
         subject_id = get_subject_id_from_filename(file_path.name)
-        subject_label = get_label_for_subject(subject_id, Label)
+        subject_label = get_label_for_subject(subject_id)
 
         if not subject_label:
             print(f"Warning: No label found for subject {subject_id}")
             return
 
         # Check if output already exists (to avoid reprocessing)
-        output_filename = f"{file_path.stem}_processed.csv"  # ใช้ชื่อไฟล์ที่ต่างจากไฟล์ต้นฉบับ
+        output_filename = f"{file_path.stem}_processed.{OUTPUT_FORMAT}"  # ใช้ชื่อไฟล์ที่ต่างจากไฟล์ต้นฉบับ
         output_path = PROCESSED_PATH / output_filename
         
         # Create directory if it doesn't exist
         PROCESSED_PATH.mkdir(parents=True, exist_ok=True)
         
-        # ทดสอบว่าสามารถเขียนไฟล์ได้หรือไม่
-        try:
-            with open(output_path, 'a') as f:
-                pass  # Just testing if we can write to this path
-        except PermissionError:
+        # ทดสอบว่าสามารถเขียนไฟล์ได้หรือไม่ (ไม่สร้างไฟล์เปล่าทิ้งไว้ให้บังไฟล์ CSV เดิม)
+        if not os.access(PROCESSED_PATH, os.W_OK):
             print(f"Permission error on {output_path}, trying alternative location")
             # สร้างชื่อไฟล์ทางเลือกในโฟลเดอร์ผู้ใช้
             alt_path = Path(os.path.expanduser("~")) / "PPG_Processed"
@@ -191,7 +441,7 @@ def process_ppg_file(file_path: Path) -> None:
             print(f"Using alternative path: {output_path}")
 
         # Load data
-        data = pd.read_csv(file_path)
+        data = read_ppg_csv(file_path)
         print(f"Processing {file_path.name}, data shape: {data.shape}")
 
         # Process timestamp
@@ -199,7 +449,7 @@ def process_ppg_file(file_path: Path) -> None:
 
         # Identify PPG signal column
         ppg_columns = [col for col in data.columns if
-                      any(ppg in col.lower() for ppg in ['ppg', 'pg', 'photoplethysmography', 'pulse'])]
+                      any(ppg in col.lower() for ppg in PPG_COLUMN_KEYWORDS)]
 
         if ppg_columns:
             ppg_column = ppg_columns[0]
@@ -211,14 +461,25 @@ def process_ppg_file(file_path: Path) -> None:
             print(f"Using column '{ppg_column}' as PPG signal (best guess)")
 
         # Ensure PPG data is numeric and clean
-        data[ppg_column] = pd.to_numeric(data[ppg_column], errors='coerce')
-        if data[ppg_column].isna().any():
-            data[ppg_column].interpolate(method='linear', inplace=True)
+        if data[ppg_column].dtype.kind != 'f':
+            data[ppg_column] = pd.to_numeric(data[ppg_column], errors='coerce')
+        ppg_values = data[ppg_column].to_numpy(dtype=np.float64)
+        missing = np.isnan(ppg_values)
+        if missing.any() and not missing.all():
+            # Linear fill like Series.interpolate(): gaps before the first valid sample stay NaN
+            positions = np.arange(len(ppg_values))
+            valid = ~missing
+            to_fill = missing & (positions > np.argmax(valid))
+            ppg_values = ppg_values.copy()
+            ppg_values[to_fill] = np.interp(positions[to_fill], positions[valid], ppg_values[valid])
+        # float32 is plenty for the PPG signal and halves the memory traffic
+        data[ppg_column] = ppg_values.astype(np.float32)
 
         # --- 2. Process PPG signal using neurokit2 ---
         try:
             # Process the entire signal
-            signals, info = nk.ppg_process(data[ppg_column], sampling_rate=SAMPLING_RATE)
+            signals = process_ppg_signal(data[ppg_column], SAMPLING_RATE)
+            signals = signals.astype({col: np.float32 for col in signals.columns if signals[col].dtype == np.float64})
             
             # Make sure we have all the required columns
             required_columns = ['PPG_Raw', 'PPG_Clean', 'PPG_Rate', 'PPG_Quality', 'PPG_Peaks']
@@ -229,12 +490,9 @@ def process_ppg_file(file_path: Path) -> None:
                     elif col == 'PPG_Quality':
                         # Generate quality metric if not present
                         signals['PPG_Quality'] = nk.signal_quality(signals['PPG_Clean'], method="zhao2018")
-                
-            # Add DateTime column from original data
-            signals['DateTime'] = data['DateTime'].values
-            
+
             # Extract peak indices
-            peak_indices = np.where(signals['PPG_Peaks'] == 1)[0]
+            peak_indices = np.flatnonzero(signals['PPG_Peaks'].to_numpy())
             print(f"Found {len(peak_indices)} peaks in {file_path.name}")
 
             if len(peak_indices) <= 10:
@@ -272,8 +530,30 @@ def process_ppg_file(file_path: Path) -> None:
         num_windows = max(1, (total_samples - WINDOW_SAMPLES) // window_shift_samples + 1)
         print(f"Processing {num_windows} sliding windows")
 
+        # Locate the peaks of every window up front instead of masking all peaks per window
+        window_starts = first_window_start_idx + np.arange(num_windows, dtype=np.int64) * window_shift_samples
+        window_ends = np.minimum(window_starts + WINDOW_SAMPLES, total_samples)
+        peak_lo, peak_hi = find_window_peak_bounds(peak_indices.astype(np.int64), window_starts, window_ends)
+
+        # Window start times trimmed to whole seconds, taken by sample position
+        window_times = pd.to_datetime(data['DateTime'].iloc[window_starts]).dt.floor('s').to_numpy()
+
+        # Signal means and basic RR statistics for all windows at once
+        # (every window start and end is a multiple of this block size, so the channels are summed per block first)
+        mean_block_size = int(np.gcd(window_shift_samples, WINDOW_SAMPLES))
+        signal_means = {col: window_means(signals[col].to_numpy(), window_starts, window_ends, mean_block_size)
+                        for col in ['PPG_Raw', 'PPG_Clean', 'PPG_Rate', 'PPG_Quality']
+                        if col in signals.columns}
+        # PPG_Peaks is 1 only at the peaks, so its mean is the peak count over the window length
+        signal_means['PPG_Peaks'] = (peak_hi - peak_lo) / (window_ends - window_starts)
+        window_hr, window_rr_mean, window_rmssd, window_sdnn = window_rr_stats(
+            peak_indices.astype(np.int64), peak_lo, peak_hi, SAMPLING_RATE)
+
         # Pre-allocate list for results
         all_window_results = []
+        # Window index of every result row, and whether that row takes the basic RR statistics
+        kept_windows = []
+        needs_rr_stats = []
 
         # --- 4. Process each window ---
         for window_idx in range(num_windows):
@@ -289,19 +569,12 @@ def process_ppg_file(file_path: Path) -> None:
                     if (end_idx - start_idx) < (WINDOW_SAMPLES * 0.6):
                         break
                     
-                # Set window_time using data timestamp
-                window_time = data['DateTime'].iloc[start_idx]
-                
                 # Debug timestamps for first few windows
                 if window_idx < 3:
-                    print(f"Window {window_idx}: start_idx={start_idx}, time={window_time}")
-                
-                # Clean microseconds if needed
-                if hasattr(window_time, 'replace'):
-                    window_time = window_time.replace(microsecond=0)
+                    print(f"Window {window_idx}: start_idx={start_idx}, time={window_times[window_idx]}")
 
                 # Get peaks within this window
-                window_peak_indices = peak_indices[(peak_indices >= start_idx) & (peak_indices < end_idx)]
+                window_peak_indices = peak_indices[peak_lo[window_idx]:peak_hi[window_idx]]
                 
                 # Adjust indices to be relative to window start
                 window_peak_indices_adjusted = window_peak_indices - start_idx
@@ -316,16 +589,9 @@ def process_ppg_file(file_path: Path) -> None:
 
                 # Create a result row for this window
                 window_result = {
-                    'DateTime': window_time,
                     'NumPeaks': len(window_peak_indices_adjusted)
                 }
                 
-                # Add PPG signal metrics for this window
-                window_slice = slice(start_idx, end_idx)
-                for col in ['PPG_Raw', 'PPG_Clean', 'PPG_Rate', 'PPG_Quality', 'PPG_Peaks']:
-                    if col in signals.columns:
-                        window_result[col] = signals[col][window_slice].mean()
-                
                 # Add HRV metrics
                 hrv_metrics = {}
                 
@@ -334,7 +600,7 @@ def process_ppg_file(file_path: Path) -> None:
                     if len(window_peak_indices_adjusted) >= 30:
                         # Calculate all HRV metrics
                         hrv_time = nk.hrv_time(window_peak_indices_adjusted, sampling_rate=SAMPLING_RATE, show=False)
-                        hrv_freq = nk.hrv_frequency(window_peak_indices_adjusted, sampling_rate=SAMPLING_RATE, show=False)
+                        hrv_freq = pd.DataFrame([hrv_frequency_welch(window_peak_indices_adjusted, SAMPLING_RATE)])
                         hrv_nonlinear = nk.hrv_nonlinear(window_peak_indices_adjusted, sampling_rate=SAMPLING_RATE, show=False)
                         
                         # Combine all metrics
@@ -371,16 +637,12 @@ def process_ppg_file(file_path: Path) -> None:
                 for key, value in hrv_metrics.items():
                     window_result[key] = value
                 
-                # Basic HR and RR calculations if missing
-                if 'HR' not in window_result and len(window_peak_indices_adjusted) >= 2:
-                    rr_intervals = np.diff(window_peak_indices_adjusted) / SAMPLING_RATE
-                    window_result['HR'] = 60 / np.mean(rr_intervals) if np.mean(rr_intervals) > 0 else np.nan
-                    window_result['RR_Mean'] = np.mean(rr_intervals) * 1000  # in ms
-                    window_result['RMSSD'] = np.sqrt(np.mean(np.diff(rr_intervals * 1000) ** 2)) if len(rr_intervals) > 1 else np.nan
-                    window_result['SDNN'] = np.std(rr_intervals * 1000)  # in ms
+                # Basic HR and RR calculations if missing (filled in after the loop)
+                needs_rr_stats.append('HR' not in window_result and len(window_peak_indices_adjusted) >= 2)
                 
                 # Append to results list
                 all_window_results.append(window_result)
+                kept_windows.append(window_idx)
             except Exception as e:
                 print(f"Error processing window {window_idx+1}: {e}")
                 continue
@@ -392,6 +654,24 @@ def process_ppg_file(file_path: Path) -> None:
             
         # Create dataframe from all window results
         processed_data = pd.DataFrame(all_window_results)
+        kept_windows = np.array(kept_windows, dtype=np.int64)
+        processed_data.insert(0, 'DateTime', window_times[kept_windows])
+        
+        # Add PPG signal metrics as whole columns (right after NumPeaks)
+        for position, (col, means) in enumerate(signal_means.items(), start=2):
+            processed_data.insert(position, col, means[kept_windows])
+        
+        # Add basic HR and RR statistics (RR_Mean, RMSSD, SDNN in ms) as whole columns
+        needs_rr_stats = np.array(needs_rr_stats, dtype=bool)
+        if needs_rr_stats.any():
+            for col, values in [('HR', window_hr), ('RR_Mean', window_rr_mean),
+                                ('RMSSD', window_rmssd), ('SDNN', window_sdnn)]:
+                if col in processed_data.columns:
+                    column = processed_data[col].to_numpy(dtype=np.float64, copy=True)
+                else:
+                    column = np.full(len(processed_data), np.nan)
+                column[needs_rr_stats] = values[kept_windows[needs_rr_stats]]
+                processed_data[col] = column
         
         # Ensure all required columns are present
         required_column_list = [
@@ -408,13 +688,12 @@ def process_ppg_file(file_path: Path) -> None:
         if 'DateTime' in processed_data.columns:
             processed_data.set_index('DateTime', inplace=True)
         
-        # Add subject label information
-        for key, value in subject_label.items():
-            processed_data[key] = value
+        # Add subject label information (all label columns in one step)
+        processed_data = processed_data.assign(**subject_label)
             
         # --- 6. Save processed data ---
         try:
-            processed_data.to_csv(output_path, index=True)
+            save_processed_data(processed_data, output_path)
             print(f'Successfully processed {file_path.name} and saved to {output_path}')
         except Exception as save_error:
             print(f"Error saving to {output_path}: {save_error}")
@@ -422,7 +701,7 @@ def process_ppg_file(file_path: Path) -> None:
             alt_path = Path(os.path.expanduser("~")) / "PPG_Processed"
             alt_path.mkdir(parents=True, exist_ok=True)
             alt_output = alt_path / output_filename
-            processed_data.to_csv(alt_output, index=True)
+            save_processed_data(processed_data, alt_output)
             print(f'Saved to alternative location: {alt_output}')
         
 
@@ -513,8 +792,9 @@ def main():
 
     print(f'Found {len(files)} files to process')
 
-    for file_path in files:
-        process_ppg_file(file_path)
+    # Files are independent, so process them in parallel (one file per worker at a time)
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(files))) as executor:
+        list(executor.map(process_ppg_file, files, chunksize=1))
 
 
 if __name__ == '__main__':
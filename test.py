@@ -6,14 +6,14 @@ pd.set_option('display.width', None)
 pd.set_option('display.max_rows', None)
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
 
-# Read the CSV file
-df = pd.read_csv('Combined\ppg\combined_ppg_data.csv')
+# Read the combined Parquet file
+df = pd.read_parquet('Combined/ppg/combined_ppg_data.parquet')
 
 # Display full description
 print(df.describe())
-df.describe().to_csv('Combined\ppg\combined_ppg_data_description.csv')
+df.describe().to_csv('Combined/ppg/combined_ppg_data_description.csv')
 
-df = pd.read_csv('Combined\eda\combined_eda_data.csv')
+df = pd.read_parquet('Combined/eda/combined_eda_data.parquet')
 print(df.describe())
-df.describe().to_csv('Combined\eda\combined_eda_data_description.csv')
+df.describe().to_csv('Combined/eda/combined_eda_data_description.csv')
 
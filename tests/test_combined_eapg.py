@@ -0,0 +1,79 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# ใช้ Numba cache แยก เพราะ cache จากการรันสคริปต์ตรงๆ โหลดซ้ำผ่าน importlib ไม่ได้
+os.environ.setdefault('NUMBA_CACHE_DIR', tempfile.mkdtemp())
+
+SCRIPT_PATH = Path(__file__).resolve().parent.parent / 'Concat_code' / 'Combined_eapg.py'
+spec = importlib.util.spec_from_file_location('Combined_eapg', SCRIPT_PATH)
+combined_eapg = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(combined_eapg)
+
+
+def write_subject_csv(file_path: Path, subject_id: str, gender: str):
+    pd.DataFrame({
+        'DateTime': ['2024-03-21 13:00:00+07:00', '2024-03-21 13:00:01+07:00'],
+        'EA': [0.1, 0.2],
+        'id': [subject_id, subject_id],
+        'gender': [gender, gender],
+    }).to_csv(file_path, index=False)
+
+
+class LoadAllCsvFromDirTest(unittest.TestCase):
+    def test_mixes_cached_and_uncached_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            directory_path = Path(tmp_dir)
+            write_subject_csv(directory_path / 'S01_eda.csv', 'S01', 'male')
+            write_subject_csv(directory_path / 'S02_eda.csv', 'S02', 'female')
+
+            # รอบแรกสร้าง cache ของทุกไฟล์
+            combined_eapg.load_all_csv_from_dir(directory_path)
+            # ทำให้ cache ของ S01 เก่ากว่าไฟล์ต้นฉบับ รอบถัดไปจึงอ่าน cache เพียงไฟล์เดียว
+            cache_mtime = combined_eapg.get_sidecar_path(directory_path / 'S01_eda.csv').stat().st_mtime
+            os.utime(directory_path / 'S01_eda.csv', (cache_mtime + 10, cache_mtime + 10))
+
+            combined_df = combined_eapg.load_all_csv_from_dir(directory_path)
+
+        self.assertEqual(combined_df.shape, (4, 4))
+        self.assertEqual(combined_df['gender'].dtype.name, 'category')
+        self.assertEqual(list(combined_df['id']), ['S01', 'S01', 'S02', 'S02'])
+
+
+def random_timestamps(rng, size: int) -> np.ndarray:
+    """Sorted nanosecond timestamps on a 0.5 s grid, so duplicates and exact ties are common"""
+    return np.sort(rng.integers(0, 60, size=size)).astype(np.int64) * 500_000_000
+
+
+class FindNearestIndicesTest(unittest.TestCase):
+    def test_matches_merge_asof(self):
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            left_ns = random_timestamps(rng, int(rng.integers(0, 40)))
+            right_ns = random_timestamps(rng, int(rng.integers(0, 40)))
+            # การจับคู่เดิมใช้ merge_asof แบบ nearest ระยะไม่เกิน 1 วินาที
+            expected = pd.merge_asof(
+                pd.DataFrame({'DateTime': pd.to_datetime(left_ns)}),
+                pd.DataFrame({'DateTime': pd.to_datetime(right_ns), 'right_idx': np.arange(len(right_ns))}),
+                on='DateTime',
+                direction='nearest',
+                tolerance=pd.Timedelta('1s'),
+            )['right_idx'].fillna(-1).to_numpy(dtype=np.int64)
+
+            right_idx = combined_eapg.find_nearest_indices(left_ns, right_ns, combined_eapg.MERGE_TOLERANCE_NS)
+            np.testing.assert_array_equal(right_idx, expected)
+
+    def test_tie_prefers_earlier_row(self):
+        left_ns = np.array([1_000_000_000], dtype=np.int64)
+        right_ns = np.array([500_000_000, 1_500_000_000], dtype=np.int64)
+        right_idx = combined_eapg.find_nearest_indices(left_ns, right_ns, combined_eapg.MERGE_TOLERANCE_NS)
+        np.testing.assert_array_equal(right_idx, [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Numba cache ที่สคริปต์เขียนตอนรันเป็น __main__ โหลดผ่าน importlib ไม่ได้ จึงแยก cache ของเทสต์ไว้ต่างหาก
+os.environ.setdefault('NUMBA_CACHE_DIR', tempfile.mkdtemp())
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+SCRIPT_PATH = REPO_PATH / 'eda-process.py'
+# สคริปต์โหลด label.json จาก path ปัจจุบันตอน import
+current_dir = os.getcwd()
+os.chdir(REPO_PATH)
+try:
+    spec = importlib.util.spec_from_file_location('eda_process', SCRIPT_PATH)
+    eda_process = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(eda_process)
+finally:
+    os.chdir(current_dir)
+
+
+def random_signals(rng, size: int, tz=None) -> pd.DataFrame:
+    """Signals on a 0.25 s grid with duplicate timestamps, gaps of empty seconds and NaN values"""
+    ts_ns = 1_732_950_847_000_000_000 + np.sort(rng.integers(0, 80, size=size)).astype(np.int64) * 250_000_000
+    index = pd.DatetimeIndex(ts_ns, name='DateTime')
+    if tz is not None:
+        index = index.tz_localize('UTC').tz_convert(tz)
+    values = rng.normal(size=(size, 3))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    return pd.DataFrame(values, index=index, columns=['EDA_Raw', 'EDA_Clean', 'EDA_Tonic'])
+
+
+class ResampleTest(unittest.TestCase):
+    def test_resample_mean_matches_pandas(self):
+        rng = np.random.default_rng(0)
+        for case in range(100):
+            signals = random_signals(rng, int(rng.integers(1, 60)), tz='Asia/Bangkok' if case % 2 else None)
+            bucket_ids, bucket_index = eda_process.get_bucket_ids(signals.index)
+            result = eda_process.resample_mean(signals, bucket_ids, bucket_index)
+            pd.testing.assert_frame_equal(result, signals.resample('1s').mean(), check_freq=False, rtol=1e-12)
+
+    def test_resample_first_matches_pandas(self):
+        rng = np.random.default_rng(1)
+        for _ in range(50):
+            signals = random_signals(rng, int(rng.integers(1, 60)))
+            signals['label'] = np.where(rng.random(len(signals)) < 0.3, None, 'stress')
+            bucket_ids, bucket_index = eda_process.get_bucket_ids(signals.index)
+            result = eda_process.resample_first(signals, bucket_ids, bucket_index)
+            # process_eda_file เติมค่าว่างด้วย ffill เสมอ (ช่องว่างเป็น NaN หรือ None ก็ได้ผลเหมือนกัน)
+            pd.testing.assert_frame_equal(result.ffill(), signals.resample('1s').first().ffill(), check_freq=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
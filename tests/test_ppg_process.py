@@ -0,0 +1,70 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+# Keep the test's Numba cache apart from the one written when the script runs as __main__
+os.environ.setdefault('NUMBA_CACHE_DIR', tempfile.mkdtemp())
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+SCRIPT_PATH = REPO_PATH / 'ppg-process.py'
+# สคริปต์โหลด label.json จาก path ปัจจุบันตอน import
+current_dir = os.getcwd()
+os.chdir(REPO_PATH)
+try:
+    spec = importlib.util.spec_from_file_location('ppg_process', SCRIPT_PATH)
+    ppg_process = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ppg_process)
+finally:
+    os.chdir(current_dir)
+
+
+def baseline_rr_stats(peak_indices, window_starts, window_ends, sampling_rate):
+    """Per-window HR, RR_Mean, RMSSD and SDNN with the original numpy formulas"""
+    results = np.full((4, len(window_starts)), np.nan)
+    for w, (start, end) in enumerate(zip(window_starts, window_ends)):
+        window_peaks = peak_indices[(peak_indices >= start) & (peak_indices < end)]
+        if len(window_peaks) < 2:
+            continue
+        rr_intervals = np.diff(window_peaks) / sampling_rate
+        results[0, w] = 60 / np.mean(rr_intervals) if np.mean(rr_intervals) > 0 else np.nan
+        results[1, w] = np.mean(rr_intervals) * 1000
+        results[2, w] = np.sqrt(np.mean(np.diff(rr_intervals * 1000) ** 2)) if len(rr_intervals) > 1 else np.nan
+        results[3, w] = np.std(rr_intervals * 1000)
+    return results
+
+
+class WindowRrStatsTest(unittest.TestCase):
+    def check_windows(self, peak_indices, window_starts, window_size, total_samples, sampling_rate=100):
+        peak_indices = np.asarray(peak_indices, dtype=np.int64)
+        window_starts = np.asarray(window_starts, dtype=np.int64)
+        window_ends = np.minimum(window_starts + window_size, total_samples)
+        peak_lo, peak_hi = ppg_process.find_window_peak_bounds(peak_indices, window_starts, window_ends)
+        expected = baseline_rr_stats(peak_indices, window_starts, window_ends, sampling_rate)
+        # py_func ใช้ numpy indexing จึงเจอ IndexError ถ้าอ่านเกินขอบ rr
+        for kernel in (ppg_process.window_rr_stats, ppg_process.window_rr_stats.py_func):
+            result = np.array(kernel(peak_indices, peak_lo, peak_hi, sampling_rate))
+            np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-9, equal_nan=True)
+
+    def test_empty_and_single_peak_windows_at_end_of_record(self):
+        self.check_windows([100, 180, 260, 340, 420], np.arange(0, 600, 100), 200, 600)
+
+    def test_no_peaks(self):
+        self.check_windows([], np.arange(0, 600, 100), 200, 600)
+
+    def test_random_peaks(self):
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            total_samples = int(rng.integers(1_000, 5_000))
+            n_peaks = int(rng.integers(0, 60))
+            peak_indices = np.sort(rng.choice(total_samples, size=n_peaks, replace=False))
+            window_size = int(rng.integers(50, 800))
+            window_shift = int(rng.integers(10, 200))
+            self.check_windows(peak_indices, np.arange(0, total_samples, window_shift), window_size, total_samples)
+
+
+if __name__ == '__main__':
+    unittest.main()